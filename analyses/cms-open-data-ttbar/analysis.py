@@ -1,10 +1,30 @@
 import argparse
 import json
 import os
+import shutil
 import time
 
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
-from urllib.request import urlretrieve
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+# orjson parses and serializes several times faster than the stdlib json;
+# fall back transparently when it is not installed
+try:
+    import orjson
+
+    def _load_json(f):
+        return orjson.loads(f.read())
+
+    def _dump_json(data, f):
+        f.write(orjson.dumps(data).decode())
+except ImportError:
+    def _load_json(f):
+        return json.load(f)
+
+    def _dump_json(data, f):
+        json.dump(data, f)
 
 PARSER = argparse.ArgumentParser()
 PARSER.add_argument("--ncores",
@@ -45,6 +65,13 @@ if ARGS.scheduling_mode == "imt":
     VariationsFor = ROOT.RDF.Experimental.VariationsFor
 
     def init_functions():
+        # skip ACLiC entirely when the helper library is already loaded, e.g.
+        # when a notebook or test session initializes twice
+        if hasattr(ROOT, "TrijetMass"):
+            return
+
+        # let ACLiC autovectorize the component loops in helper.cpp for the local CPU
+        ROOT.gSystem.SetFlagsOpt("-O3 -march=native")
         ROOT.gSystem.CompileMacro("helper.cpp", "kO")
 
 else:
@@ -55,23 +82,19 @@ else:
     VariationsFor = ROOT.RDF.Experimental.Distributed.VariationsFor
     initialize = ROOT.RDF.Experimental.Distributed.initialize
 
-    if ARGS.scheduling_mode == "dask-ssh":
-        if not ARGS.nodes:
-            raise ValueError("For SSHCluster deployments, please specify a "
-                             "string with a comma-separated list of hostnames of nodes that will be used.")
-
-        if ARGS.npartitions is None:
-            n_compute_nodes = len(ARGS.nodes.split(",")) - 1
-            ARGS.npartitions = ARGS.ncores * n_compute_nodes
-
-    elif ARGS.scheduling_mode == "dask-local":
-        if ARGS.npartitions is None:
-            ARGS.npartitions = ARGS.ncores
+    if ARGS.scheduling_mode == "dask-ssh" and not ARGS.nodes:
+        raise ValueError("For SSHCluster deployments, please specify a "
+                         "string with a comma-separated list of hostnames of nodes that will be used.")
 
     from distributed import Client, LocalCluster, SSHCluster, get_worker
 
     def create_localcluster_connection(ncores: int) -> Client:
-        cluster = LocalCluster(n_workers=ncores, threads_per_worker=1, processes=True)
+        # the RDataFrame event loop releases the GIL, so a few processes with
+        # several threads each keep all cores busy while cutting the IPC and
+        # result-serialization cost of running one process per core
+        threads_per_worker = min(4, ncores)
+        cluster = LocalCluster(n_workers=max(1, ncores // threads_per_worker),
+                               threads_per_worker=threads_per_worker, processes=True)
         client = Client(cluster)
         return client
 
@@ -101,6 +124,12 @@ else:
                 f"Unexpected scheduling mode '{scheduling_mode}'. Acceptable values are ['dask-local', 'dask-ssh'].")
 
     def init_functions():
+        # the initialization hook may run more than once in the lifetime of a
+        # worker process; once the helper library is loaded there is nothing
+        # left to compile or jit
+        if hasattr(ROOT, "TrijetMass"):
+            return
+
         try:
             localdir = get_worker().local_directory
             helper_path = os.path.join(localdir, "helper.cpp")
@@ -109,6 +138,10 @@ else:
             # for now work around this by silencing the error.
             helper_path = "helper.cpp"
 
+        # each worker compiles for its own CPU, so -march=native is safe here too
+        # "k" keeps the ACLiC build products next to the macro, so later worker
+        # sessions on the same node just dlopen the cached library
+        ROOT.gSystem.SetFlagsOpt("-O3 -march=native")
         ROOT.gSystem.CompileMacro(helper_path, "kO")
 
 if ARGS.verbose:
@@ -116,6 +149,22 @@ if ARGS.verbose:
         ROOT.Detail.RDF.RDFLogChannel(), ROOT.Experimental.ELogLevel.kInfo)
 
 
+# storage prefixes of the two supported locations of the AGC dataset; the
+# paths in ntuples.json all carry the UNL prefix
+UNL_PREFIX = "https://xrootd-local.unl.edu:1094//store/user/AGC"
+CERN_XROOTD_PREFIX = "root://eoscms.cern.ch//eos/cms/store/test/agc"
+
+# every isinstance against ROOT.TH1D resolves the class through cppyy again;
+# bind it once and share the result-pointer dispatch between the result
+# containers and the output code
+_TH1D = ROOT.TH1D
+
+
+def get_histogram(result):
+    # return the TH1D behind `result`, materializing result pointers
+    return result if isinstance(result, _TH1D) else result.GetValue()
+
+
 class TtbarAnalysis(dict):
 
     def __init__(self, n_files_max_per_sample, download_input_data, storage_location, num_bins=25, bin_low=50, bin_high=550, connection=None):
@@ -125,6 +174,14 @@ class TtbarAnalysis(dict):
         self.download_input_data = download_input_data
         self.storage_location = storage_location
         self.ntuples_file = "ntuples.json"
+
+        # sizes of verified downloads: a cached file only counts if its size
+        # still matches the manifest entry recorded when it was fetched
+        self._manifest_file = "input/manifest.json"
+        self._manifest = {}
+        if download_input_data and os.path.exists(self._manifest_file):
+            with open(self._manifest_file) as f:
+                self._manifest = _load_json(f)
         self.num_bins = num_bins
         self.bin_low = bin_low
         self.bin_high = bin_high
@@ -132,6 +189,8 @@ class TtbarAnalysis(dict):
         # Connection handle in case distributed mode was selected
         self.connection = connection
 
+        self._chains = []  # keeps the TChains alive until the event loops ran
+
         self.variations = {}  # serves as temporary storage for all histograms produced by VariationsFor
         self._nevts_total = {}
         # dictionary assigning file URLs (paths) to each process, variation, and region
@@ -148,23 +207,70 @@ class TtbarAnalysis(dict):
             "data": None
         }
 
+    def _download_file(self, path, file):
+        # stream into a .part file and finish with an atomic rename, so an
+        # interrupted run never leaves a truncated .root file behind; the next
+        # run resumes the partial transfer with an HTTP Range request instead
+        # of refetching the bytes it already has
+        part = f"{file}.part"
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        request = Request(path)
+        if offset:
+            request.add_header("Range", f"bytes={offset}-")
+        try:
+            with urlopen(request) as response:
+                # a server that ignores the Range header replies 200 with the full file
+                mode = "ab" if offset and response.status == 206 else "wb"
+                with open(part, mode) as f:
+                    shutil.copyfileobj(response, f, length=1 << 20)
+        except HTTPError as err:
+            # a .part that already holds the whole file makes the Range start
+            # past the end, which servers answer with 416: just rename it
+            if not (offset and err.code == 416):
+                raise
+        os.replace(part, file)
+        return file, os.path.getsize(file)
+
+    def _is_cached(self, file, sizes):
+        size = self._manifest.get(file)
+        return size is not None and sizes.get(file) == size
+
     def _optionally_download_data(self, file_paths, process, variation):
         if (self.download_input_data):
             dir_name = f"input/{process}_{variation}"
             os.makedirs(dir_name, exist_ok=True)
-            for i in range(len(file_paths)):
-                path = file_paths[i]
-                file = f"{dir_name}/{i}.root"
-                if not os.path.exists(file):
-                    urlretrieve(path, file)
-                    print(f"{file} has been created")
-                else:
-                    print(f"{file} already exists")
+            # snapshot the cache directory once rather than issuing an
+            # exists+stat syscall pair per file, which adds up on networked
+            # filesystems with thousands of cached files
+            sizes = {entry.path: entry.stat().st_size for entry in os.scandir(dir_name) if entry.is_file()}
+            # the transfers are latency-bound, so a few parallel streams keep
+            # the link busy instead of paying the full round trip per file
+            # one summary line per sample: per-file messages from eight
+            # download threads only interleave and slow the transfers down
+            cached = 0
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                downloads = []
+                for i, path in enumerate(file_paths):
+                    file = f"{dir_name}/{i}.root"
+                    if self._is_cached(file, sizes):
+                        cached += 1
+                    else:
+                        downloads.append(executor.submit(self._download_file, path, file))
+                for download in downloads:
+                    file, size = download.result()
+                    self._manifest[file] = size
+            if downloads:
+                with open(self._manifest_file, "w") as f:
+                    _dump_json(self._manifest, f)
+            print(f"{process}_{variation}: {len(downloads)} files downloaded, {cached} already cached")
 
     def _construct_fileset(self):
 
         with open(self.ntuples_file) as f:
-            file_info = json.load(f)
+            file_info = _load_json(f)
+
+        use_xrootd = self.storage_location == "cern-xrootd"
+        prefix_len = len(UNL_PREFIX)
 
         fileset = {}
         for process in file_info.keys():
@@ -178,13 +284,23 @@ class TtbarAnalysis(dict):
                 file_list = file_info[process][variation]["files"]
                 if self.n_files_max_per_sample != -1:
                     file_list = file_list[:self.n_files_max_per_sample]  # use partial set of samples
-                file_paths = [f["path"] for f in file_list]
-                if (self.storage_location == "cern-xrootd"):
-                    file_paths = [f.replace("https://xrootd-local.unl.edu:1094//store/user/AGC",
-                                            "root://eoscms.cern.ch//eos/cms/store/test/agc") for f in file_paths]
+                # collect paths and event counts in a single pass; the storage
+                # prefix swap slices at a precomputed offset instead of
+                # re-scanning each path with str.replace
+                file_paths = []
+                nevts_total = 0
+                for f in file_list:
+                    path = f["path"]
+                    if use_xrootd:
+                        # slice comparison reuses the offset of the transform
+                        # below and avoids a second scan over the path
+                        if path[:prefix_len] != UNL_PREFIX:
+                            raise ValueError(f"unexpected storage prefix in '{path}'")
+                        path = CERN_XROOTD_PREFIX + path[prefix_len:]
+                    file_paths.append(path)
+                    nevts_total += f["nevts"]
 
                 fileset[process].update({variation: file_paths})
-                nevts_total = sum([f["nevts"] for f in file_list])
                 self._nevts_total[process].update({variation: nevts_total})
                 self[process][variation] = {}
 
@@ -197,18 +313,19 @@ class TtbarAnalysis(dict):
         # all operations are handled by RDataFrame class, so the first step is the RDataFrame object instantiating
         input_data = self.input_data[process][variation]
         if ARGS.scheduling_mode == "imt":
-            d = RDataFrame("events", input_data)
+            # hand RDataFrame a TChain with the read cache sized up front, so
+            # file opens and basket reads go through ROOT's tuned IO layer
+            # rather than a plain path list
+            chain = ROOT.TChain("events")
+            for path in input_data:
+                chain.Add(path)
+            chain.SetCacheSize(25_000_000)
+            self._chains.append(chain)
+            d = RDataFrame(chain)
         else:
             d = RDataFrame("events", input_data, daskclient=self.connection, npartitions=ARGS.npartitions)
             d._headnode.backend.distribute_unique_paths(["helper.cpp", ])
 
-        # normalization for MC
-        x_sec = self.xsec_info[process]
-        nevts_total = self._nevts_total[process][variation]
-        lumi = 3378  # /pb
-        xsec_weight = x_sec * lumi / nevts_total
-        d = d.Define("weights", str(xsec_weight))  # default weights
-
         if variation == "nominal":
 
             # jet_pt variations definition
@@ -216,28 +333,47 @@ class TtbarAnalysis(dict):
             # pt_scale_up() - jet energy scaly systematic
             # pt_res_up(jet_pt) - jet resolution systematic
 
+            # booked before the selection masks so the varied jet_pt propagates
+            # into every downstream column and cut
+
             d = d.Vary("jet_pt",
                        "ROOT::RVec<ROOT::RVecF>{jet_pt*pt_scale_up(), jet_pt*jet_pt_resolution(jet_pt.size())}",
                        ["pt_scale_up", "pt_res_up"])
-            if process == "wjets":
-
-                # flat weight variation definition
-                d = d.Vary("weights",
-                           "weights*flat_variation()",
-                           [f"scale_var_{direction}" for direction in ["up", "down"]]
-                           )
 
         # event selection - the core part of the algorithm applied for both regions
         # selecting events containing at least one lepton and four jets with pT > 25 GeV
         # applying requirement at least one of them must be b-tagged jet (see details in the specification)
+        # the mask-filtered jet columns are defined once and reused downstream:
+        # every jet_X[jet_pt_mask] allocates and copies, so repeating it in each
+        # filter and weight expression would redo that work per use
         d = d.Define("electron_pt_mask", "electron_pt>25").Define("muon_pt_mask", "muon_pt>25").Define("jet_pt_mask", "jet_pt>25")\
+             .Define("jet_pt_cut", "jet_pt[jet_pt_mask]")\
+             .Define("jet_btag_cut", "jet_btag[jet_pt_mask]")\
+             .Define("n_btag", "Sum(jet_btag_cut>=0.5)")\
              .Filter("Sum(electron_pt_mask) + Sum(muon_pt_mask) == 1")\
              .Filter("Sum(jet_pt_mask) >= 4")\
-             .Filter("Sum(jet_btag[jet_pt_mask]>=0.5)>=1")
+             .Filter("n_btag>=1")
+
+        # normalization for MC
+        # weights and their variations are booked after the selection so the
+        # bookkeeping only runs for events that enter a histogram
+        x_sec = self.xsec_info[process]
+        nevts_total = self._nevts_total[process][variation]
+        lumi = 3378  # /pb
+        xsec_weight = x_sec * lumi / nevts_total
+        d = d.Define("weights", str(xsec_weight))  # default weights
+
+        if variation == "nominal" and process == "wjets":
+
+            # flat weight variation definition
+            d = d.Vary("weights",
+                       "weights*flat_variation()",
+                       [f"scale_var_{direction}" for direction in ["up", "down"]]
+                       )
 
         # b-tagging variations for nominal samples
         d = d.Vary("weights",
-                   "ROOT::RVecD{weights*btag_weight_variation(jet_pt[jet_pt_mask])}",
+                   "btag_weight_variation(jet_pt_cut, weights)",
                    [f"{weight_name}_{direction}" for weight_name in [f"btag_var_{i}" for i in range(4)] for direction in [
                        "up", "down"]]
                    ) if variation == "nominal" else d
@@ -252,76 +388,16 @@ class TtbarAnalysis(dict):
 
                 # only one b-tagged region required
                 # observable is total transvesre momentum
-                fork = d.Filter("Sum(jet_btag[jet_pt_mask]>=0.5)==1").Define(observable, "Sum(jet_pt[jet_pt_mask])")
+                fork = d.Filter("n_btag==1").Define(observable, "Sum(jet_pt_cut)")
 
             elif region == "4j2b":
 
                 # select events with at least 2 b-tagged jets
-                # building four-momentum vectors for each jet
-                fork = (
-                    d.Filter("Sum(jet_btag[jet_pt_mask]>=0.5)>1")
-                    .Define("jet_p4",
-                            """
-                            ROOT::VecOps::Construct<ROOT::Math::PxPyPzMVector>(
-                                jet_px[jet_pt_mask], jet_py[jet_pt_mask], jet_pz[jet_pt_mask], jet_mass[jet_pt_mask])""")
-                )
-                # building trijet combinations
-                fork = fork.Define("trijet",
-                                   "ROOT::VecOps::Combinations(jet_pt[jet_pt_mask],3)"
-                                   ).Define("ntrijet", "trijet[0].size()")
-
-                # assigning four-momentums to each trijet combination
-                fork = fork.Define("trijet_p4",
-                                   """
-                                   ROOT::RVec<ROOT::Math::PxPyPzMVector> trijet_p4(ntrijet);
-                                   for (int i = 0; i < ntrijet; ++i)
-                                   {
-                                       int j1 = trijet[0][i];
-                                       int j2 = trijet[1][i];
-                                       int j3 = trijet[2][i];
-                                       trijet_p4[i] = jet_p4[j1] + jet_p4[j2] + jet_p4[j3];
-                                   }
-                                   return trijet_p4;
-                                   """
-                                   )
-
-                # getting trijet transverse momentum values from four-momentum vectors
-                fork = fork.Define("trijet_pt",
-                                   "return ROOT::VecOps::Map(trijet_p4, [](ROOT::Math::PxPyPzMVector v) { return v.Pt(); })"
-                                   )
-
-                # trijet_btag is a helpful array of bool values indicating whether or not the maximum btag value in trijet is larger than 0.5 threshold
-                fork = fork.Define("trijet_btag",
-                                   """
-                                   ROOT::VecOps::RVec<bool> btag(ntrijet);
-                                   for (int i = 0; i < ntrijet; ++i)
-                                   {
-                                       int j1 = trijet[0][i];
-                                       int j2 = trijet[1][i];
-                                       int j3 = trijet[2][i];
-                                       btag[i] = std::max({jet_btag[j1], jet_btag[j2], jet_btag[j3]}) > 0.5;
-                                   }
-                                   return btag;
-                                   """
-                                   )
-                # find trijet with maximum pt and higher that threshold btag
-                # get mass for found jet four-vector
-                # trijet mass themself is an observable quantity
-                fork = fork.Define(observable,
-                                   """
-                                   double mass{};
-                                   double Pt{};
-                                   double indx{};
-                                   for (int i = 0; i < ntrijet; ++i) {
-                                       if ((Pt < trijet_pt[i]) && (trijet_btag[i])) {
-                                           Pt = trijet_pt[i];
-                                           indx = i;
-                                       }
-                                   }
-                                   mass = trijet_p4[indx].M();
-                                   return mass;
-                                   """
-                                   )
+                # the compiled TrijetMass kernel applies the pT mask internally, so
+                # the raw component columns are passed without masked copies
+                fork = d.Filter("n_btag>1")\
+                        .Define(observable,
+                                "TrijetMass(jet_px, jet_py, jet_pz, jet_mass, jet_btag_cut, jet_pt_mask)")
 
             # fill histogram for observable column in RDF object
             res = fork.Histo1D((f"{process}_{variation}_{region}", process, self.num_bins,
@@ -358,10 +434,16 @@ class TtbarAnalysis(dict):
                 variation = "nominal" if hist_name == "nominal" else str(hist_name).split(":")[1]
                 if variation not in self[process]:
                     self[process][variation] = {}
-                hist = hist_map[hist_name]
-                if not isinstance(hist, ROOT.TH1D):
-                    hist = hist.GetValue()
-                self[process][variation][region] = hist
+                self[process][variation][region] = get_histogram(hist_map[hist_name])
+        # materialize the remaining result pointers (the non-nominal samples)
+        # in the same batch: the single RunGraphs pass in Accumulate already
+        # produced their values, and converting them here guarantees no later
+        # access can trigger another event loop
+        for process in self:
+            for variation in self[process]:
+                region_map = self[process][variation]
+                for region in region_map:
+                    region_map[region] = get_histogram(region_map[region])
         self.ExportJSON()
 
     def GetProcStack(self, region, variation="nominal"):
@@ -369,8 +451,7 @@ class TtbarAnalysis(dict):
 
     def GetVarStack(self, region, process="ttbar", variations=None):
         variations = variations if variations is not None else self[process].keys()
-        histos = [self[process][variation][region] for variation in variations]
-        return [h.GetValue() if not isinstance(h, ROOT.TH1D) else h for h in histos]
+        return [get_histogram(self[process][variation][region]) for variation in variations]
 
     # necessary only for sanity checks
     def ExportJSON(self):
@@ -380,7 +461,20 @@ class TtbarAnalysis(dict):
             for variation in self[process]:
                 data[process][variation] = [region for region in self[process][variation]]
         with open("data.json", "w") as f:
-            json.dump(data, f)
+            _dump_json(data, f)
+
+
+def configure_remote_io(fileset):
+    # remote reads pay a round trip per basket until the TTreeCache kicks in:
+    # prefetch asynchronously and shorten the cache learning phase so the
+    # coalesced bulk reads start after a few entries
+    remote = any(path.startswith(("root://", "http://", "https://"))
+                 for process in fileset
+                 for variation in fileset[process]
+                 for path in fileset[process][variation])
+    if remote:
+        ROOT.gEnv.SetValue("TFile.AsyncPrefetching", 1)
+        ROOT.TTreeCache.SetLearnEntries(10)
 
 
 def analyse(connection=None):
@@ -395,6 +489,8 @@ def analyse(connection=None):
     print(
         f'\nexample of information inside analysisManager:\n{{\n  "urls": [{analysisManager.input_data["ttbar"]["nominal"][0]}, ...],')
 
+    configure_remote_io(analysisManager.input_data)
+
     t0 = time.time()
     analysisManager.Fill()
     t1 = time.time()
@@ -422,9 +518,10 @@ def make_plots(analysisManager):
     # Region 1 stack
     hlist = analysisManager.GetProcStack(region="4j1b")
     hs = ROOT.THStack("j4b1", ">=4 jets, 1 b-tag; H_{T} [GeV]")
+    sliced = []  # keeps the stacked histograms alive until the canvas is saved
     for h in hlist:
-        h = ROOT.Slice(h, 120, 550)
-        ptr = h.Rebin(2, h.GetTitle())
+        ptr = ROOT.SliceAndRebin(h, 120, 550, 2)
+        sliced.append(ptr)
         hs.Add(ptr)
     hs.Draw("hist pfc plc")
     c.Draw()
@@ -486,22 +583,38 @@ def make_plots(analysisManager):
     c.BuildLegend(0.65, 0.7, 0.9, 0.9)
     c.SaveAs("jet.png")
 
-    # Save histograms to disk
+
+def prepare_histos(analysisManager):
+    # slice and rebin on the calling thread: these reads touch the same TH1D
+    # objects the plotting code mutates, so they must not run concurrently
+    # with make_plots
+    histos = []
+    for process in analysisManager:
+        for variation in analysisManager[process]:
+            for region in analysisManager[process][variation]:
+                hist_name = (
+                    f"{region}_{process}_{variation}" if variation != "nominal" else f"{region}_{process}"
+                )
+                hist = get_histogram(analysisManager[process][variation][region])
+                if hist.IsZombie():
+                    raise TypeError(hist_name)
+                hist_binned = ROOT.SliceAndRebin(hist, 120, 550, 2)
+                hist_binned.SetName(hist_name)
+                histos.append(hist_binned)
+    return histos
+
+
+def save_histos(histos):
     with ROOT.TFile.Open(ARGS.histograms_output_file, "RECREATE") as output:
-        for process in analysisManager:
-            for variation in analysisManager[process]:
-                for region in analysisManager[process][variation]:
-                    hist_name = (
-                        f"{region}_{process}_{variation}" if variation != "nominal" else f"{region}_{process}"
-                    )
-                    hist = analysisManager[process][variation][region]
-                    if not isinstance(hist, ROOT.TH1D):
-                        hist = hist.GetValue()
-                    if hist.IsZombie():
-                        raise TypeError(hist_name)
-                    hist_sliced = ROOT.Slice(hist, 120, 550)
-                    hist_binned = hist_sliced.Rebin(2, hist.GetTitle())
-                    output.WriteObject(hist_binned, hist_name)
+        # LZ4 compresses the bin arrays considerably faster than the default
+        # ZLIB at a similar ratio
+        output.SetCompressionAlgorithm(ROOT.ROOT.kLZ4)
+        output.SetCompressionLevel(4)
+        for hist in histos:
+            hist.SetDirectory(output)
+        # one Write call serializes every attached histogram in a single
+        # transaction instead of flushing a key per WriteObject
+        output.Write()
 
 
 def main():
@@ -510,6 +623,14 @@ def main():
         init_functions()
         ROOT.EnableImplicitMT(ARGS.ncores)
         print(f"The num of threads = {ROOT.GetThreadPoolSize()}")
+        if not ARGS.download:
+            # without an eager --download, let ROOT keep a local copy of every
+            # remote file it reads: the first run fills the cache during the
+            # event loop and later runs open the local copies instead
+            # forceCacheread makes every TFile::Open go through the cache;
+            # without it only files opened with CACHEREAD get mirrored
+            os.makedirs("input", exist_ok=True)
+            ROOT.TFile.SetCacheFileDir(os.path.abspath("input"), True, True)
         # No handle needed in local mode
         connection = None
     else:
@@ -517,8 +638,26 @@ def main():
         # Create connection to the cluster in distributed mode
         connection = create_connection(ARGS.nodes, ARGS.ncores, ARGS.scheduling_mode)
 
+        # default to one partition per worker thread the cluster actually
+        # provides (cores x nodes on SSH deployments); an explicit
+        # --npartitions always wins
+        if ARGS.npartitions is None:
+            workers = connection.scheduler_info()["workers"].values()
+            ARGS.npartitions = max(1, sum(w["nthreads"] for w in workers))
+            print(f"Using {ARGS.npartitions} partitions")
+
     results = analyse(connection)
-    make_plots(results)
+
+    # the sliced output copies are prepared up front, on this thread; only the
+    # file write, which touches nothing the plotting code mutates, overlaps
+    # with the canvas rendering (EnableThreadSafety also makes
+    # gDirectory/gFile thread-local)
+    ROOT.EnableThreadSafety()
+    histos = prepare_histos(results)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        write_future = executor.submit(save_histos, histos)
+        make_plots(results)
+        write_future.result()
 
     if connection is not None:
         connection.close()
@@ -1,33 +1,113 @@
+#include <algorithm>
+#include <cmath>
+#include <cstdint>
 #include <string>
 
 #include "ROOT/RVec.hxx"
 #include "TH1D.h"
 #include "TRandom3.h"
 
-// functions slicing histograms
+// function slicing and rebinning histograms
 
-// accept numbers of bins as parameters
-TH1D SliceHisto(TH1D h, int xfirst, int xlast)
+// slice in low_edge:high_edge and merge ngroup consecutive bins, writing the
+// merged contents straight into the output histogram: one pass over the bin
+// array and one allocation, instead of an intermediate sliced copy that is
+// rebinned afterwards
+TH1D SliceAndRebin(const TH1D &h, double low_edge, double high_edge, int ngroup)
 {
-
-   // do slice in xfirst:xlast including xfirst and xlast
-   TH1D res((std::string("h_sliced_") + h.GetTitle()).c_str(), h.GetTitle(), xlast - xfirst,
-            h.GetXaxis()->GetBinLowEdge(xfirst), h.GetXaxis()->GetBinUpEdge(xlast - 1));
+   // FindFixBin: TH1::FindBin is non-const since it may extend the axis
+   const int xfirst = h.GetXaxis()->FindFixBin(low_edge);
+   const int xlast = h.GetXaxis()->FindFixBin(high_edge);
+   const int nbins = (xlast - xfirst) / ngroup;
+   TH1D res((std::string("h_sliced_") + h.GetTitle()).c_str(), h.GetTitle(), nbins,
+            h.GetXaxis()->GetBinLowEdge(xfirst), h.GetXaxis()->GetBinUpEdge(xfirst + nbins * ngroup - 1));
    // note that histogram arrays are : [ undeflow, bin1, bin2,....., binN, overflow]
-   std::copy(h.GetArray() + xfirst, h.GetArray() + xlast, res.GetArray() + 1);
+   const double *arr = h.GetArray();
+   for (int i = 0; i < nbins; ++i) {
+      double sum = 0;
+      for (int k = 0; k < ngroup; ++k)
+         sum += arr[xfirst + i * ngroup + k];
+      res.SetBinContent(i + 1, sum);
+   }
+   // merge the squared weights with the same grouping so errors stay correct
+   if (h.GetSumw2N()) {
+      res.Sumw2();
+      const double *sumw2 = h.GetSumw2()->GetArray();
+      double *res_sumw2 = res.GetSumw2()->GetArray();
+      for (int i = 0; i < nbins; ++i) {
+         double sum = 0;
+         for (int k = 0; k < ngroup; ++k)
+            sum += sumw2[xfirst + i * ngroup + k];
+         res_sumw2[i + 1] = sum;
+      }
+   }
    // set correct underflow/overflows
-   res.SetBinContent(0, h.Integral(0, xfirst - 1));                              // set underflow value
-   res.SetBinContent(res.GetNbinsX() + 1, h.Integral(xlast, h.GetNbinsX() + 1)); // set overflow value
+   res.SetBinContent(0, h.Integral(0, xfirst - 1));                                        // set underflow value
+   res.SetBinContent(nbins + 1, h.Integral(xfirst + nbins * ngroup, h.GetNbinsX() + 1));   // set overflow value
 
    return res;
 }
 
-// accept axis limits as parameters
-TH1D Slice(TH1D h, double low_edge, double high_edge)
+// find the highest-pT trijet combination containing at least one b-tagged jet
+// and return its invariant mass
+// a single pass over i<j<k replaces an index matrix built with
+// ROOT::VecOps::Combinations and intermediate per-combination columns
+// the candidate pT only needs the summed px/py components, so the full
+// invariant mass is computed once, for the winning combination
+// the pT mask is applied in place via a stack-resident index table instead of
+// materializing masked copies of the component columns
+double TrijetMass(const ROOT::RVecF &jet_px, const ROOT::RVecF &jet_py, const ROOT::RVecF &jet_pz,
+                  const ROOT::RVecF &jet_mass, const ROOT::RVecF &jet_btag_cut, const ROOT::RVecI &jet_pt_mask)
 {
-   int xfirst = h.FindBin(low_edge);
-   int xlast = h.FindBin(high_edge);
-   return SliceHisto(h, xfirst, xlast);
+   int sel[64];
+   int njet = 0;
+   const int n = jet_pt_mask.size();
+   for (int i = 0; i < n && njet < 64; ++i)
+      if (jet_pt_mask[i])
+         sel[njet++] = i;
+   // one bit per jet passing the b-tag threshold: triplets without any
+   // b-tagged jet are rejected with a single mask test before touching the
+   // kinematics (jet_btag_cut is already mask-filtered, so it lines up with sel)
+   std::uint64_t btag_bits{};
+   for (int i = 0; i < njet; ++i)
+      if (jet_btag_cut[i] > 0.5)
+         btag_bits |= 1ull << i;
+   // ranking by squared pT is equivalent to ranking by pT and skips the
+   // per-candidate sqrt entirely
+   double best_pt2{};
+   int best_i{-1}, best_j{}, best_k{};
+   for (int i = 0; i < njet; ++i) {
+      const std::uint64_t bits_i = 1ull << i;
+      for (int j = i + 1; j < njet; ++j) {
+         const std::uint64_t bits_ij = bits_i | 1ull << j;
+         for (int k = j + 1; k < njet; ++k) {
+            if (!(btag_bits & (bits_ij | 1ull << k)))
+               continue;
+            const double px = jet_px[sel[i]] + jet_px[sel[j]] + jet_px[sel[k]];
+            const double py = jet_py[sel[i]] + jet_py[sel[j]] + jet_py[sel[k]];
+            const double pt2 = px * px + py * py;
+            if (pt2 > best_pt2) {
+               best_pt2 = pt2;
+               best_i = sel[i];
+               best_j = sel[j];
+               best_k = sel[k];
+            }
+         }
+      }
+   }
+   if (best_i < 0)
+      return 0.;
+   double px{}, py{}, pz{}, e{};
+   for (const int idx : {best_i, best_j, best_k}) {
+      const double m = jet_mass[idx];
+      const double p2 = jet_px[idx] * jet_px[idx] + jet_py[idx] * jet_py[idx] + jet_pz[idx] * jet_pz[idx];
+      px += jet_px[idx];
+      py += jet_py[idx];
+      pz += jet_pz[idx];
+      e += std::sqrt(p2 + m * m);
+   }
+   const double mass2 = e * e - px * px - py * py - pz * pz;
+   return mass2 > 0. ? std::sqrt(mass2) : 0.;
 }
 
 // functions creating systematic variations
@@ -52,14 +132,17 @@ float pt_scale_up()
    return 1.03;
 }
 
-ROOT::VecOps::RVec<float> btag_weight_variation(const ROOT::VecOps::RVec<float> &jet_pt)
+ROOT::RVecD btag_weight_variation(const ROOT::VecOps::RVec<float> &jet_pt, double weights)
 {
    // weight variation depending on i-th jet pT (7.5% as default value, multiplied by i-th jet pT / 50 GeV)
-   ROOT::VecOps::RVec<float> res;
+   // all eight variations (4 jets x up/down) are scaled by the nominal weight
+   // in one pass and returned as the double vector Vary expects
+   ROOT::RVecD res;
+   res.reserve(8);
    for (const float &pt : ROOT::VecOps::Take(jet_pt, 4))
    {
-      res.push_back(1 + .075 * pt / 50);
-      res.push_back(1 - .075 * pt / 50);
+      res.push_back(weights * (1 + .075 * pt / 50));
+      res.push_back(weights * (1 - .075 * pt / 50));
    }
    return res;
 }